@@ -0,0 +1,34 @@
+#!/usr/bin/env bash
+# Convert the Hugging Face model to a quantized whisper.cpp (ggml) model
+# Used by the server with WHISPER_BACKEND=whispercpp
+#
+# Usage: ./convert_and_quantize.sh [q5_0|q4_0|q8_0]
+set -euo pipefail
+
+QUANT="${1:-q5_0}"
+MODEL_ID="tarteel-ai/whisper-base-ar-quran"
+WORK_DIR="${WORK_DIR:-./build_ggml}"
+OUT_DIR="${OUT_DIR:-./models}"
+
+mkdir -p "$WORK_DIR" "$OUT_DIR"
+OUT_DIR="$(cd "$OUT_DIR" && pwd)"
+cd "$WORK_DIR"
+
+# whisper.cpp (converter + quantize tool) and openai/whisper (mel filters used by the converter)
+[ -d whisper.cpp ] || git clone --depth 1 https://github.com/ggerganov/whisper.cpp
+[ -d whisper ] || git clone --depth 1 https://github.com/openai/whisper
+python -c "from huggingface_hub import snapshot_download; snapshot_download('$MODEL_ID', local_dir='hf-model')"
+
+# HF checkpoint -> ggml (writes ./ggml-model.bin)
+python whisper.cpp/models/convert-h5-to-ggml.py hf-model whisper .
+
+# Build the quantize tool (named whisper-quantize in newer releases)
+cmake -S whisper.cpp -B whisper.cpp/build -DCMAKE_BUILD_TYPE=Release
+cmake --build whisper.cpp/build -j --config Release
+QUANTIZE=whisper.cpp/build/bin/whisper-quantize
+[ -x "$QUANTIZE" ] || QUANTIZE=whisper.cpp/build/bin/quantize
+
+OUTPUT="$OUT_DIR/ggml-base-ar-quran-$QUANT.bin"
+"$QUANTIZE" ggml-model.bin "$OUTPUT" "$QUANT"
+
+echo "✓ Quantized model written to $OUTPUT"
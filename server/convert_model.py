@@ -2,6 +2,8 @@
 Convert Hugging Face format Whisper model to single .pt file
 This script converts a model from Hugging Face directory format to a single .pt file
 that can be used with openai-whisper library.
+Pass an output path ending in .safetensors to write a safetensors file instead, for tools that
+load state dicts from safetensors (the server itself loads the model from the Hugging Face Hub).
 """
 
 import torch
@@ -13,6 +15,57 @@ from pathlib import Path
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def load_state_dict(data_pkl_path: str):
+    """Load a state dict from a bare data.pkl (not a zip checkpoint, so it can't be memory-mapped)"""
+    return torch.load(data_pkl_path, map_location="cpu")
+
+def drop_shared_tensors(state_dict):
+    """
+    Keep one name per shared tensor, which safetensors requires
+    Whisper ties proj_out to the decoder token embeddings; proj_out is the copy dropped, as
+    transformers re-ties it on load
+    """
+    kept = {}
+    seen = {}
+    # proj_out.* sorts last so the embedding keeps its name
+    for name, tensor in sorted(state_dict.items(), key=lambda item: item[0].startswith("proj_out")):
+        key = (tensor.untyped_storage().data_ptr(), tensor.storage_offset(), tuple(tensor.shape))
+        if tensor.numel() and key in seen:
+            logger.info(f"Dropping {name} (shared with {seen[key]})")
+            continue
+        seen[key] = name
+        kept[name] = tensor.contiguous()
+    return kept
+
+def convert_hf_to_safetensors(model_dir: str, output_path: str):
+    """
+    Convert Hugging Face format model directory to a single .safetensors file
+    Tensors are written as raw buffers - no pickle re-serialization
+    
+    Args:
+        model_dir: Path to the pytorch_model directory
+        output_path: Path where to save the .safetensors file
+    """
+    from safetensors.torch import save_file
+    
+    data_pkl_path = os.path.join(model_dir, "data.pkl")
+    if not os.path.exists(data_pkl_path):
+        raise FileNotFoundError(f"data.pkl not found in {model_dir}")
+    
+    logger.info("Loading state dict from data.pkl...")
+    state_dict = load_state_dict(data_pkl_path)
+    logger.info(f"State dict loaded. Keys: {len(state_dict.keys())}")
+    
+    logger.info("Saving state dict as .safetensors...")
+    save_file(drop_shared_tensors(state_dict), output_path)
+    
+    file_size = os.path.getsize(output_path) / (1024 * 1024)
+    logger.info(f"✓ Model converted successfully!")
+    logger.info(f"✓ Output file: {output_path}")
+    logger.info(f"✓ File size: {file_size:.1f} MB")
+    
+    return output_path
+
 def convert_hf_to_pt(model_dir: str, output_path: str):
     """
     Convert Hugging Face format model directory to single .pt file
@@ -31,7 +84,7 @@ def convert_hf_to_pt(model_dir: str, output_path: str):
         
         # Load the state dict from data.pkl
         logger.info("Loading state dict from data.pkl...")
-        state_dict = torch.load(data_pkl_path, map_location="cpu")
+        state_dict = load_state_dict(data_pkl_path)
         
         logger.info(f"State dict loaded. Keys: {len(state_dict.keys())}")
         logger.info(f"Sample keys: {list(state_dict.keys())[:5]}")
@@ -72,9 +125,10 @@ def convert_hf_to_pt(model_dir: str, output_path: str):
 def main():
     """Main conversion function"""
     if len(sys.argv) < 2:
-        print("Usage: python convert_model.py <model_directory> [output_file.pt]")
+        print("Usage: python convert_model.py <model_directory> [output_file.pt|output_file.safetensors]")
         print("\nExample:")
         print("  python convert_model.py pytorch_model whisper_tiny_ar_quran.pt")
+        print("  python convert_model.py pytorch_model whisper_tiny_ar_quran.safetensors")
         print("  python convert_model.py models/pytorch_model")
         sys.exit(1)
     
@@ -91,8 +145,8 @@ def main():
         else:
             output_path = f"{dir_name}.pt"
     
-    # Ensure output path has .pt extension
-    if not output_path.endswith('.pt'):
+    # Ensure output path has .pt (or .safetensors) extension
+    if not output_path.endswith(('.pt', '.safetensors')):
         output_path += '.pt'
     
     # Check if model directory exists
@@ -111,7 +165,10 @@ def main():
         sys.exit(1)
     
     try:
-        convert_hf_to_pt(model_dir, output_path)
+        if output_path.endswith('.safetensors'):
+            convert_hf_to_safetensors(model_dir, output_path)
+        else:
+            convert_hf_to_pt(model_dir, output_path)
         print(f"\n✅ Success! Model converted to: {output_path}")
         print(f"\nNext steps:")
         print(f"1. Upload {output_path} to Dropbox")
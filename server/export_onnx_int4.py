@@ -0,0 +1,60 @@
+"""
+Export the Hugging Face Whisper model to ONNX and quantize its weights to INT4
+Produces the model directory used by the server with WHISPER_BACKEND=onnx
+(MatMul weights become MatMulNBits blocks; activations stay fp32)
+
+Usage: python export_onnx_int4.py [output_dir]
+"""
+
+import os
+import sys
+import logging
+from pathlib import Path
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MODEL_ID = "tarteel-ai/whisper-base-ar-quran"
+
+def export_onnx(output_dir: str):
+    """Export encoder and decoder (with past key values) to ONNX with optimum"""
+    from optimum.exporters.onnx import main_export
+
+    logger.info(f"Exporting {MODEL_ID} to ONNX...")
+    main_export(MODEL_ID, output=output_dir, task="automatic-speech-recognition-with-past")
+
+def quantize_int4(onnx_path: Path, block_size: int = 32):
+    """Quantize the MatMul weights of one ONNX graph to symmetric INT4, in place"""
+    import onnx
+    try:
+        from onnxruntime.quantization.matmul_nbits_quantizer import MatMulNBitsQuantizer
+    except ImportError:
+        # Older onnxruntime releases name it MatMul4BitsQuantizer
+        from onnxruntime.quantization.matmul_4bits_quantizer import MatMul4BitsQuantizer as MatMulNBitsQuantizer
+
+    model = onnx.load(str(onnx_path))
+    quantizer = MatMulNBitsQuantizer(model, block_size=block_size, is_symmetric=True)
+    quantizer.process()
+    quantizer.model.save_model_to_file(str(onnx_path), use_external_data_format=False)
+    logger.info(f"✓ Quantized {onnx_path.name} ({onnx_path.stat().st_size / 1024 / 1024:.1f} MB)")
+
+def main():
+    """Main export function"""
+    output_dir = sys.argv[1] if len(sys.argv) >= 2 else os.path.join("models", "onnx-int4")
+
+    try:
+        export_onnx(output_dir)
+        for onnx_path in sorted(Path(output_dir).glob("*.onnx")):
+            quantize_int4(onnx_path)
+        print(f"\n✅ Success! INT4 ONNX model written to: {output_dir}")
+        print(f"\nRun the server with WHISPER_BACKEND=onnx ONNX_MODEL_DIR={output_dir}")
+    except ImportError as e:
+        logger.error(f"Missing dependency: {e}")
+        logger.error("Install with: pip install optimum[onnxruntime]")
+        sys.exit(1)
+    except Exception as e:
+        logger.error(f"Export failed: {e}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -4,31 +4,151 @@ Production inference server for fine-tuned Whisper model
 Downloads model from Hugging Face at startup and caches on disk
 """
 
-from fastapi import FastAPI, File, UploadFile, HTTPException
+import os
+import asyncio
+import importlib.util
+
+MODEL_CACHE_DIR = os.getenv("MODEL_CACHE_DIR", "./models_cache")
+
+def physical_core_count():
+    """
+    Physical cores this process may run on: the CPU affinity set (taskset, cgroup cpusets)
+    with hyperthread siblings counted once. Falls back to os.cpu_count() off Linux
+    """
+    if not hasattr(os, "sched_getaffinity"):
+        return os.cpu_count() or 1
+    cores = set()
+    for cpu in os.sched_getaffinity(0):
+        try:
+            with open(f"/sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list") as f:
+                cores.add(f.read().strip())
+        except OSError:
+            cores.add(str(cpu))
+    return len(cores)
+
+# One shared thread budget for torch/oneDNN, MKL and OpenMP. Must be set before any numeric
+# import, otherwise each library sizes its own pool to the core count and small containers thrash.
+# The budget is one thread per physical core (GEMM threads on hyperthread siblings stall on the
+# same memory bandwidth), split between WORKERS uvicorn processes; WHISPER_THREADS overrides it.
+WORKERS = int(os.getenv("WORKERS", "1"))
+if os.getenv("WHISPER_THREADS"):
+    os.environ["OMP_NUM_THREADS"] = os.environ["WHISPER_THREADS"]
+os.environ.setdefault("OMP_NUM_THREADS", str(max(1, physical_core_count() // WORKERS)))
+os.environ.setdefault("MKL_NUM_THREADS", os.environ["OMP_NUM_THREADS"])
+os.environ.setdefault("OPENBLAS_NUM_THREADS", "1")
+os.environ.setdefault("NUMEXPR_NUM_THREADS", "1")
+NUM_THREADS = int(os.environ["OMP_NUM_THREADS"])
+
+# Persist torch.compile (Inductor) artifacts next to the model cache so restarts reuse
+# compiled kernels instead of recompiling. Must be set before torch is imported.
+os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.abspath(os.path.join(MODEL_CACHE_DIR, "inductor")))
+os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+os.environ.setdefault("TORCH_LOGS", "recompiles")
+
+# CUDA caching allocator: expandable segments avoid fragmentation from varying activation sizes
+os.environ.setdefault(
+    "PYTORCH_CUDA_ALLOC_CONF",
+    "expandable_segments:True,max_split_size_mb:256,garbage_collection_threshold:0.8"
+)
+
+# Cold-start downloads: hf_transfer fetches each weight file over parallel range requests.
+# Only enabled when installed - huggingface_hub errors out if the flag is set without it.
+if importlib.util.find_spec("hf_transfer") is not None:
+    os.environ.setdefault("HF_HUB_ENABLE_HF_TRANSFER", "1")
+
+from fastapi import FastAPI, File, UploadFile, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from starlette.formparsers import MultiPartParser
 import torch
-import os
-import tempfile
+import torchaudio
+import torchaudio.transforms as AT
+import numpy as np
+import soundfile as sf
+from numpy.lib.stride_tricks import sliding_window_view
+import torch.ao.quantization as tq
+from huggingface_hub import HfApi, snapshot_download, try_to_load_from_cache
+from transformers import WhisperProcessor, WhisperForConditionalGeneration
+from transformers.modeling_outputs import BaseModelOutput
+from transformers.models.whisper.tokenization_whisper import LANGUAGES
+import contextlib
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import subprocess
+import threading
+import gc
 import logging
-from pathlib import Path
+from logging.handlers import QueueHandler, QueueListener
+import atexit
+import queue
+import hashlib
+from collections import OrderedDict
+import time
 from typing import Optional
+import orjson
 import uvicorn
 
-# Configure logging
+try:
+    import webrtcvad  # Optional: silence gate before inference
+except ImportError:
+    webrtcvad = None
+
+# Configure logging: request threads only enqueue records, a listener thread does the writing
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+_log_queue = queue.SimpleQueue()
+_log_listener = QueueListener(_log_queue, _log_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
 logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
+    handlers=[QueueHandler(_log_queue)]
 )
 logger = logging.getLogger(__name__)
 
+# Keep uploads up to 10 MB in RAM (Starlette spools anything over 1 MB to a temp file on disk);
+# the attribute was renamed from max_file_size to spool_max_size in newer Starlette releases
+UPLOAD_SPOOL_MAX_SIZE = 10 * 1024 * 1024
+MultiPartParser.max_file_size = UPLOAD_SPOOL_MAX_SIZE
+MultiPartParser.spool_max_size = UPLOAD_SPOOL_MAX_SIZE
+# Largest upload accepted by /transcribe; bigger ones get HTTP 413
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_MB", "20")) * 1024 * 1024
+
 app = FastAPI(
     title="Whisper Arabic Transcription API",
     description="Production inference server for tarteel-ai/whisper-base-ar-quran (upgraded from tiny)",
-    version="2.0.0"
+    version="2.0.0",
+    default_response_class=ORJSONResponse  # orjson: faster serialization, UTF-8 text as-is
 )
 
+class UploadSizeLimitMiddleware:
+    """
+    Answer 413 from Content-Length before the multipart body is read and spooled
+    Pure ASGI (no BaseHTTPMiddleware task group / stream per request) and only /transcribe is
+    checked, so health probes and streamed responses pass straight through
+    """
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] == "/transcribe":
+            for name, value in scope["headers"]:
+                if name == b"content-length":
+                    if value.isdigit() and int(value) > MAX_UPLOAD_BYTES:
+                        response = ORJSONResponse(
+                            {"detail": f"Upload too large (limit {MAX_UPLOAD_BYTES // (1024 * 1024)} MB)"},
+                            status_code=413,
+                        )
+                        await response(scope, receive, send)
+                        return
+                    break
+        await self.app(scope, receive, send)
+
+app.add_middleware(UploadSizeLimitMiddleware)
+
 # CORS middleware - allow requests from React Native app
+# (added last so it wraps the 413 responses above too)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # In production, restrict to your app domain
@@ -37,85 +157,1168 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Global model, processor, and pipeline
+# Global model, processor, and cached feature-extraction tensors
 model = None
 processor = None
-pipe = None  # Cache the pipeline for faster inference
+# (feature extractor, mel filter bank, Hann window, feature dtype), cached on device at load time;
+# replaced as one tuple so requests preprocessing during /reload-model never see a mixed set
+mel_frontend = None
+# {language code: <|code|> token id} from the tokenizer, for detect_language(); built at load time
+# (legacy generation configs have no lang_to_id)
+language_token_ids = None
+ct2_model = None  # faster-whisper (CTranslate2) model when WHISPER_BACKEND=ct2
+encoder_session = None  # ONNX Runtime encoder session when ONNX_ENCODER=1
+jit_encoder = None  # Frozen TorchScript encoder when JIT_ENCODER=1
+whispercpp_model = None  # whisper.cpp model when WHISPER_BACKEND=whispercpp
+ort_model = None  # ONNX Runtime (optimum) model when WHISPER_BACKEND=onnx
 device = "cuda" if torch.cuda.is_available() else "cpu"
 model_loaded = False
+model_compiled = False  # torch.compile succeeded: decode shapes are limited to the captured ones
+
+# Inference only: no autograd bookkeeping (generate() itself runs under inference_context())
+torch.set_grad_enabled(False)
+
+# Intra-op pool from the shared thread budget, no nested inter-op pool
+torch.set_num_threads(NUM_THREADS)
+# Only settable once per process: spawned uvicorn workers import this module twice
+# (as __mp_main__ and as main through "main:app"), and the second call would raise
+if torch.get_num_interop_threads() != 1:
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError as e:
+        logger.warning(f"Inter-op thread count already fixed: {e}")
+
+if device == "cpu":
+    # Flush denormals to zero (avoids slow denormal math in the mel filter bank multiplies)
+    torch.set_flush_denormal(True)
+else:
+    # TF32 GEMMs/convolutions on Ampere and newer
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    # Input shape is fixed (30s log-mel), so autotuned conv algorithms are picked once at warm-up
+    torch.backends.cudnn.benchmark = True
 
 # Model configuration
 MODEL_ID = "tarteel-ai/whisper-base-ar-quran"  # Upgraded from tiny to base for better accuracy
-MODEL_CACHE_DIR = os.getenv("MODEL_CACHE_DIR", "./models_cache")
+
+# Encoded / and /health bodies, keyed by the state they report
+_status_payloads = {}
+
+# Accepted upload file extensions
+ALLOWED_EXTENSIONS = frozenset({'.wav', '.mp3', '.m4a', '.ogg', '.flac', '.webm', '.mpeg', '.mp4'})
+
+# MP4 containers may keep their index (moov atom) at the end of the file, which ffmpeg can't reach
+# through a pipe - these are decoded from the seekable upload file object instead
+FFMPEG_SEEK_FORMATS = frozenset({'m4a', 'mp4'})
+
+# Per-request preprocessing buffers (30s at 16kHz), reused across requests
+MAX_SCRATCH_SAMPLES = 16000 * 30
+_scratch_buffers = queue.SimpleQueue()
+
+# Resample transforms keyed by source sample rate (44.1k/48k from phones, 8k from telephony)
+_resamplers = {}
+
+# Longer audio is decoded as consecutive windows of at most this length (Whisper's 30s input at
+# 16kHz), each cut at the quietest 100ms of its last 5s; no window is shorter than 2s
+CHUNK_SAMPLES = 16000 * 30
+WINDOW_CUT_SEARCH_SAMPLES = 16000 * 5
+MIN_WINDOW_SAMPLES = 16000 * 2
+
+# Clips up to this length (5s at 16kHz) are not silence-trimmed
+SILENCE_TRIM_MIN_SAMPLES = 16000 * 5
+
+# WebRTC VAD gate: uploads with less voiced speech than this are answered without inference
+VAD_MIN_SPEECH_MS = int(os.getenv("VAD_MIN_SPEECH_MS", "200"))
+VAD_AGGRESSIVENESS = int(os.getenv("VAD_AGGRESSIVENESS", "2"))
+
+# Micro-batching: concurrent requests are decoded together in one generate() call
+MAX_BATCH = int(os.getenv("MAX_BATCH", "8"))
+BATCH_WAIT_SECONDS = float(os.getenv("BATCH_WAIT_MS", "10")) / 1000
+# asyncio.Queue of (input_features, language, (num_beams, max_new_tokens), future), created at startup
+pending_requests = None
+batch_worker_task = None  # Kept referenced so the running batch_worker() isn't garbage collected
+inference_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="inference")
+model_lock = None  # asyncio.Lock held while decoding and while /reload-model swaps the model
+# Language ID check before decoding (transformers backend): 422 when the audio is in another
+# language and the requested one has less than LANGUAGE_CHECK_MIN_PROB probability
+LANGUAGE_CHECK = os.getenv("LANGUAGE_CHECK", "0") == "1"
+LANGUAGE_CHECK_MIN_PROB = float(os.getenv("LANGUAGE_CHECK_MIN_PROB", "0.2"))
+# Requests decoded/preprocessed at once; further uploads wait (bounds audio buffers and GPU memory)
+MAX_INFLIGHT = int(os.getenv("MAX_INFLIGHT", str(2 * MAX_BATCH)))
+request_slots = None  # asyncio.Semaphore(MAX_INFLIGHT), created at startup
+# Decoding length limit per 30s window (default), and the most a request may ask for
+# (Whisper's 448 decoder positions minus the prompt tokens)
+MAX_NEW_TOKENS = 120
+MAX_NEW_TOKENS_LIMIT = 440
+# Largest beam size a request may ask for (default decoding is greedy)
+MAX_BEAM_SIZE = 5
+# Decoding lengths captured when the model is compiled; requests are rounded up to one of them
+# so client-chosen max_new_tokens values can't trigger recompiles
+COMPILED_DECODE_LENGTHS = (MAX_NEW_TOKENS, 2 * MAX_NEW_TOKENS, MAX_NEW_TOKENS_LIMIT)
+
+# LRU cache of transcriptions keyed by SHA-256 of the uploaded bytes (+ language)
+TRANSCRIBE_CACHE_SIZE = 1024
+_transcribe_cache = OrderedDict()
+# Futures of uploads being transcribed right now (same key), so concurrent duplicates decode once
+_inflight_transcriptions = {}
+
+# Optional shared cache (all workers/replicas) behind the in-process LRU, e.g. redis://localhost:6379/0
+REDIS_URL = os.getenv("REDIS_URL")
+REDIS_CACHE_TTL = int(os.getenv("REDIS_CACHE_TTL", "3600"))
+REDIS_KEY_PREFIX = f"transcribe:{MODEL_ID}:".encode()
+redis_client = None  # redis.asyncio client, created at startup when REDIS_URL is set
+
+# Inference backend: "transformers" (HF generate), "ct2" (faster-whisper / CTranslate2),
+# "whispercpp" (whisper.cpp with a quantized ggml model) or "onnx" (ONNX Runtime, INT4 weights)
+WHISPER_BACKEND = os.getenv("WHISPER_BACKEND", "transformers").lower()
+WHISPER_BACKENDS = ("transformers", "ct2", "whispercpp", "onnx")
+if WHISPER_BACKEND not in WHISPER_BACKENDS:
+    raise ValueError(f"Unknown WHISPER_BACKEND {WHISPER_BACKEND!r}, expected one of: {', '.join(WHISPER_BACKENDS)}")
+# Attention kernel: FlashAttention-2 on CUDA when flash-attn is installed, otherwise PyTorch SDPA
+# (fused attention instead of separate QK^T / softmax / PV matmuls)
+ATTN_IMPLEMENTATION = os.getenv("WHISPER_ATTN") or (
+    "flash_attention_2" if device == "cuda" and importlib.util.find_spec("flash_attn") is not None else "sdpa"
+)
+# Run a silent request at startup so the first real request doesn't pay one-off init costs
+WARMUP = os.getenv("WARMUP", "1") == "1"
+# torch.compile the decoder (default: on for CUDA, where CUDA graphs pay off the most)
+TORCH_COMPILE = os.getenv("TORCH_COMPILE", "1" if device == "cuda" else "0") == "1"
+# Weight dtype for the transformers backend: "float16" (default on CUDA), "bfloat16" (wider
+# range, Ampere+ / CPUs with AMX) or "float32" (default on CPU)
+WHISPER_DTYPES = {
+    "float16": torch.float16, "fp16": torch.float16, "half": torch.float16,
+    "bfloat16": torch.bfloat16, "bf16": torch.bfloat16,
+    "float32": torch.float32, "fp32": torch.float32, "float": torch.float32,
+}
+_whisper_dtype_name = os.getenv("WHISPER_DTYPE", "float16" if device == "cuda" else "float32").lower()
+if _whisper_dtype_name not in WHISPER_DTYPES:
+    raise ValueError(f"Unknown WHISPER_DTYPE {_whisper_dtype_name!r}, expected one of: {', '.join(WHISPER_DTYPES)}")
+WHISPER_DTYPE = WHISPER_DTYPES[_whisper_dtype_name]
+# Weight quantization: "int8" or "none" (default: int8 on CPU, none on GPU). On CPU the Linear
+# layers are dynamically quantized (float32 weights only); on GPU weights are int8 via optimum-quanto
+WHISPER_QUANT = os.getenv("WHISPER_QUANT", "int8" if device == "cpu" else "none").lower()
+# Run the encoder with ONNX Runtime on CPU (decoder stays in PyTorch)
+ONNX_ENCODER = os.getenv("ONNX_ENCODER", "0") == "1" and device == "cpu" and WHISPER_DTYPE == torch.float32
+ONNX_ENCODER_PATH = os.path.join(MODEL_CACHE_DIR, "onnx-" + MODEL_ID.replace("/", "--"), "encoder.onnx")
+CT2_MODEL_DIR = os.getenv(
+    "CT2_MODEL_DIR",
+    os.path.join(MODEL_CACHE_DIR, "ct2-" + MODEL_ID.replace("/", "--"))
+)
+# Quantized ggml model produced by convert_and_quantize.sh
+WHISPERCPP_MODEL = os.getenv("WHISPERCPP_MODEL", os.path.join("models", "ggml-base-ar-quran-q5_0.bin"))
+# Expected SHA-256 (hex) of the ggml file, checked at load so a truncated/corrupt copy fails fast
+WHISPERCPP_MODEL_SHA256 = os.getenv("WHISPERCPP_MODEL_SHA256")
+# INT4 ONNX model produced by export_onnx_int4.py
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", os.path.join("models", "onnx-int4"))
+# Run a frozen TorchScript trace of the encoder on CPU (ONNX_ENCODER takes precedence)
+JIT_ENCODER = os.getenv("JIT_ENCODER", "0") == "1" and device == "cpu" and not TORCH_COMPILE
+# CTranslate2 compute type (default: int8 on CPU, int8 weights + float16 activations on GPU)
+CT2_COMPUTE_TYPE = os.getenv("CT2_COMPUTE_TYPE")
+
+def acquire_scratch_buffer():
+    """Check out a preallocated float32 audio buffer (allocates one if the pool is empty)"""
+    try:
+        return _scratch_buffers.get_nowait()
+    except queue.Empty:
+        return np.empty(MAX_SCRATCH_SAMPLES, dtype=np.float32)
+
+def release_scratch_buffer(buffer):
+    """Return a buffer from acquire_scratch_buffer() to the pool"""
+    _scratch_buffers.put(buffer)
+
+def hash_upload(upload_file):
+    """
+    SHA-256 digest and size of an uploaded file, read in 1 MiB chunks
+    The upload stays in Starlette's spooled file instead of being copied into one bytes object
+    """
+    digest = hashlib.sha256()
+    upload_file.seek(0)
+    for chunk in iter(lambda: upload_file.read(1 << 20), b""):
+        digest.update(chunk)
+    size = upload_file.tell()
+    upload_file.seek(0)
+    return digest.digest(), size
+
+def file_sha256(path):
+    """Hex SHA-256 of a file, streamed in 1 MiB chunks"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def decode_with_ffmpeg(audio_file_obj, out=None):
+    """
+    Decode with the ffmpeg CLI over pipes (no temp file): upload bytes in, 16kHz mono float32 PCM out
+    ffmpeg also downmixes and resamples, so the result needs no further conversion
+    The upload is streamed to ffmpeg in 64 KiB chunks and PCM is read straight into `out`
+    """
+    cmd = ["ffmpeg", "-nostdin", "-loglevel", "error", "-i", "pipe:0",
+           "-f", "f32le", "-ac", "1", "-ar", "16000", "pipe:1"]
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    
+    def feed_stdin():
+        try:
+            for chunk in iter(lambda: audio_file_obj.read(1 << 16), b""):
+                proc.stdin.write(chunk)
+        except BrokenPipeError:
+            pass  # ffmpeg exited early; its exit status is checked below
+        finally:
+            proc.stdin.close()
+    
+    # Feed stdin from a helper thread while this one drains stdout (no pipe deadlock)
+    feeder = threading.Thread(target=feed_stdin, daemon=True)
+    feeder.start()
+    
+    if out is not None:
+        n_bytes = proc.stdout.readinto(memoryview(out).cast("B"))
+        rest = proc.stdout.read()
+        audio_array = out[:n_bytes // 4]
+        if rest:  # Longer than the scratch buffer
+            audio_array = np.concatenate([audio_array, np.frombuffer(rest, dtype=np.float32)])
+    else:
+        audio_array = np.frombuffer(bytearray(proc.stdout.read()), dtype=np.float32)
+    
+    feeder.join()
+    stderr = proc.stderr.read()
+    if proc.wait() != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, stderr=stderr)
+    return audio_array, 16000
+
+def load_audio(audio_file_obj, file_format: str, out=None):
+    """
+    Decode an uploaded audio file object to a mono float32 array
+    soundfile (libsndfile) handles WAV/FLAC/OGG/MP3; other formats (webm, ...) are piped through ffmpeg,
+    except MP4/M4A which go through torchaudio's FFmpeg backend (see FFMPEG_SEEK_FORMATS)
+    Mono audio that fits in `out` is decoded straight into it without allocating
+    """
+    try:
+        with sf.SoundFile(audio_file_obj) as audio_file:
+            sample_rate = audio_file.samplerate
+            if out is not None and audio_file.channels == 1 and 0 < audio_file.frames <= len(out):
+                return audio_file.read(out=out[:audio_file.frames]), sample_rate
+            audio_array = audio_file.read(dtype="float32", always_2d=False)
+    except RuntimeError:  # soundfile.LibsndfileError: format not supported by libsndfile (m4a, webm, ...)
+        audio_file_obj.seek(0)
+        if file_format not in FFMPEG_SEEK_FORMATS:
+            return decode_with_ffmpeg(audio_file_obj, out)
+        waveform, sample_rate = torchaudio.load(audio_file_obj, format=file_format, backend="ffmpeg")
+        return waveform.mean(dim=0).numpy(), sample_rate
+    
+    if audio_array.ndim > 1:
+        audio_array = audio_array.mean(axis=1)
+    return audio_array, sample_rate
+
+def resample_to_16k(audio_array, sample_rate):
+    """
+    Resample audio to 16kHz with a cached torchaudio Resample transform per source rate
+    The polyphase sinc kernel is built once per rate instead of on every request
+    """
+    resampler = _resamplers.get(sample_rate)
+    if resampler is None:
+        resampler = _resamplers[sample_rate] = AT.Resample(sample_rate, 16000)
+    return resampler(torch.from_numpy(audio_array)).numpy()
+
+# Normalized log-mel value of digital silence (log10 clamped at 1e-10, then (x + 4) / 4)
+SILENT_LOG_MEL = -1.5
+
+def compute_log_mel(audio_array):
+    """
+    Compute Whisper log-mel input features on the inference device
+    Same math as WhisperFeatureExtractor (pad/truncate to 30s, STFT, mel, log10, clamp, rescale)
+    but one fused torch.stft on device with cached filters instead of the numpy path
+    """
+    feature_extractor, mel_filters, stft_window, features_dtype = mel_frontend
+    n_samples = feature_extractor.n_samples
+    
+    waveform = torch.from_numpy(audio_array[:n_samples])
+    if device == "cuda":
+        # Stage through (cached) pinned host memory so the copy to the GPU is asynchronous
+        waveform = waveform.pin_memory().to(device, non_blocking=True)
+    if waveform.shape[0] < n_samples:
+        waveform = torch.nn.functional.pad(waveform, (0, n_samples - waveform.shape[0]))
+    
+    stft = torch.stft(
+        waveform,
+        feature_extractor.n_fft,
+        feature_extractor.hop_length,
+        window=stft_window,
+        return_complex=True,
+    )
+    magnitudes = stft[..., :-1].abs() ** 2
+    
+    log_spec = torch.clamp(mel_filters.T @ magnitudes, min=1e-10).log10()
+    log_spec = torch.maximum(log_spec, log_spec.max() - 8.0)
+    log_spec = (log_spec + 4.0) / 4.0
+    return log_spec.unsqueeze(0).to(features_dtype)
+
+def inference_context():
+    """
+    Context for model forward passes: inference_mode, plus fp16/bf16 autocast on CUDA so ops not
+    covered by the half-precision weights (e.g. float32 inputs) still run on tensor cores
+    """
+    stack = contextlib.ExitStack()
+    stack.enter_context(torch.inference_mode())
+    if device == "cuda" and WHISPER_DTYPE != torch.float32:
+        stack.enter_context(torch.autocast("cuda", dtype=WHISPER_DTYPE))
+    return stack
+
+def run_inference(func, *args, **kwargs):
+    """
+    Run a model call on the dedicated inference thread (awaitable)
+    Model calls are already serialized by model_lock; one long-lived thread keeps thread-local
+    torch state warm and never competes with upload hashing/decoding in the default pool
+    """
+    return asyncio.get_running_loop().run_in_executor(
+        inference_executor, functools.partial(func, *args, **kwargs)
+    )
+
+def ct2_generate_batch(input_features, languages, num_beams=1, max_new_tokens=MAX_NEW_TOKENS):
+    """Decode a batch of log-mel features with one CTranslate2 generate() call"""
+    import ctranslate2
+    
+    features = input_features.float().contiguous()
+    if features.device.type == "cpu":
+        features = features.numpy()  # CUDA tensors are shared via __cuda_array_interface__
+    prompts = [
+        ["<|startoftranscript|>", f"<|{language}|>", "<|transcribe|>", "<|notimestamps|>"]
+        for language in languages
+    ]
+    results = ct2_model.model.generate(
+        ctranslate2.StorageView.from_array(features),
+        prompts,
+        beam_size=num_beams,
+        max_length=max_new_tokens,
+    )
+    return processor.tokenizer.batch_decode(
+        [result.sequences_ids[0] for result in results], skip_special_tokens=True
+    )
+
+def language_kwargs(languages, batch_size, generation_config):
+    """
+    generate() language override for a batch: none when every row uses the language already
+    set on the generation config, else one language per row (padding rows copy the first)
+    Legacy generation configs without lang_to_id only support the forced Arabic prompt
+    """
+    if all(language == "ar" for language in languages) or not hasattr(generation_config, "lang_to_id"):
+        return {}
+    return {"language": list(languages) + [languages[0]] * (batch_size - len(languages))}
+
+def generate_batch(input_features, languages, num_beams=1, max_new_tokens=MAX_NEW_TOKENS):
+    """
+    Decode a batch of log-mel features and return one transcription per row
+    num_beams=1 (the default) is greedy decoding, the fastest option
+    """
+    if WHISPER_BACKEND == "ct2":
+        return ct2_generate_batch(input_features, languages, num_beams, max_new_tokens)
+    if WHISPER_BACKEND == "onnx":
+        predicted_ids = ort_model.generate(
+            input_features,
+            max_new_tokens=max_new_tokens,
+            num_beams=num_beams,
+            do_sample=False,
+            use_cache=True,
+            **language_kwargs(languages, input_features.shape[0], ort_model.generation_config),
+        )
+        return processor.batch_decode(predicted_ids, skip_special_tokens=True)
+    
+    batch_size = input_features.shape[0]
+    if model_compiled and batch_size < MAX_BATCH:
+        # Pad to the compiled batch size so the captured graph is reused; the padding rows are
+        # silence (not zeros, which decode like real audio) so they end after a few tokens
+        padding = input_features.new_full(
+            (MAX_BATCH - batch_size, *input_features.shape[1:]), SILENT_LOG_MEL
+        )
+        input_features = torch.cat([input_features, padding])
+    
+    generate_kwargs = language_kwargs(languages, input_features.shape[0], model.generation_config)
+    if encoder_session is not None:
+        # Encoder runs in ONNX Runtime; generate() skips its own encoder pass when given outputs
+        hidden_states = encoder_session.run(None, {"input_features": input_features.numpy()})[0]
+        generate_kwargs["encoder_outputs"] = BaseModelOutput(last_hidden_state=torch.from_numpy(hidden_states))
+    elif jit_encoder is not None:
+        with inference_context():
+            generate_kwargs["encoder_outputs"] = BaseModelOutput(last_hidden_state=jit_encoder(input_features))
+    
+    # Runs in an executor thread, where grad mode is thread-local - inference_mode is set here
+    with inference_context():
+        predicted_ids = model.generate(
+            input_features,
+            max_new_tokens=max_new_tokens,
+            num_beams=num_beams,
+            do_sample=False,  # Deterministic
+            use_cache=True,  # Enable KV cache for faster generation
+            **generate_kwargs,
+        )
+    return processor.batch_decode(predicted_ids[:batch_size], skip_special_tokens=True)
+
+def detect_language(input_features, language):
+    """
+    Whisper language ID: one decoder step after <|startoftranscript|>
+    Returns the most likely language code and the probability of the requested one
+    """
+    start_ids = torch.full(
+        (1, 1), model.generation_config.decoder_start_token_id, dtype=torch.long, device=device
+    )
+    with inference_context():
+        # Encoder/decoder modules are called directly (not the compiled forward with its static cache)
+        encoder_hidden_states = model.model.encoder(input_features).last_hidden_state
+        hidden_states = model.model.decoder(
+            input_ids=start_ids, encoder_hidden_states=encoder_hidden_states
+        ).last_hidden_state
+        logits = model.proj_out(hidden_states[0, -1])
+    
+    probs = logits[list(language_token_ids.values())].float().softmax(-1)
+    codes = list(language_token_ids)
+    requested_prob = probs[codes.index(language)].item() if language in codes else 0.0
+    return codes[int(probs.argmax())], requested_prob
+
+async def decode_batch(batch, decode_options):
+    """
+    Decode requests sharing the same (num_beams, max_new_tokens) with a single generate() call
+    and resolve their futures
+    """
+    languages = [language for _, language, _, _ in batch]
+    try:
+        input_features = torch.cat([features for features, _, _, _ in batch])
+        # Run generate() off the event loop so uploads keep being accepted meanwhile;
+        # the lock keeps /reload-model from swapping the model out mid-decode
+        async with model_lock:
+            texts = await run_inference(generate_batch, input_features, languages, *decode_options)
+    except Exception as e:
+        for _, _, _, future in batch:
+            if not future.done():
+                future.set_exception(e)
+        return
+    
+    if len(batch) > 1:
+        logger.debug(f"Decoded batch of {len(batch)} requests")
+    for (_, _, _, future), text in zip(batch, texts):
+        if not future.done():
+            future.set_result(text)
+
+async def batch_worker():
+    """
+    Collect pending requests into micro-batches and decode each batch with one generate() call
+    A batch closes BATCH_WAIT_SECONDS after its first request arrives, or at MAX_BATCH requests
+    Requests with different decoding options are decoded one group after another (never concurrently)
+    """
+    while True:
+        batch = [await pending_requests.get()]
+        # One fixed deadline: the first request never waits longer than BATCH_WAIT_SECONDS
+        deadline = time.monotonic() + BATCH_WAIT_SECONDS
+        while len(batch) < MAX_BATCH:
+            if pending_requests.empty():
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(pending_requests.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            else:
+                batch.append(pending_requests.get_nowait())
+        
+        groups = {}
+        for item in batch:
+            groups.setdefault(item[2], []).append(item)
+        for decode_options, group in groups.items():
+            try:
+                await decode_batch(group, decode_options)
+            except Exception as e:
+                # Never let one batch stop the worker: every later request would hang
+                logger.error(f"Batch worker error: {e}", exc_info=True)
+                for _, _, _, future in group:
+                    if not future.done():
+                        future.set_exception(e)
+
+def remember_transcription(cache_key, text):
+    """Store a transcription in the in-process LRU, evicting the oldest entry when full"""
+    _transcribe_cache[cache_key] = text
+    _transcribe_cache.move_to_end(cache_key)
+    if len(_transcribe_cache) > TRANSCRIBE_CACHE_SIZE:
+        _transcribe_cache.popitem(last=False)
+
+async def get_cached_transcription(cache_key):
+    """Return a cached transcription (in-process LRU first, then Redis) or None"""
+    text = _transcribe_cache.get(cache_key)
+    if text is not None:
+        _transcribe_cache.move_to_end(cache_key)
+        return text
+    
+    if redis_client is not None:
+        try:
+            value = await redis_client.get(REDIS_KEY_PREFIX + cache_key)
+        except Exception as e:
+            logger.warning(f"Redis cache lookup failed: {e}")
+            return None
+        if value is not None:
+            text = value.decode("utf-8")
+            remember_transcription(cache_key, text)
+            return text
+    return None
+
+async def cache_transcription(cache_key, text):
+    """
+    Store a transcription in the in-process LRU and, when configured, in Redis
+    Duplicate requests waiting on this upload (see _inflight_transcriptions) get the text too
+    """
+    remember_transcription(cache_key, text)
+    future = _inflight_transcriptions.pop(cache_key, None)
+    if future is not None and not future.done():
+        future.set_result(text)
+    
+    if redis_client is not None:
+        try:
+            await redis_client.set(REDIS_KEY_PREFIX + cache_key, text.encode("utf-8"), ex=REDIS_CACHE_TTL)
+        except Exception as e:
+            logger.warning(f"Redis cache store failed: {e}")
+
+def voiced_duration_ms(audio_array, frame_ms=30):
+    """
+    Milliseconds of voiced speech in 16kHz float audio according to WebRTC VAD
+    WebRTC VAD adapts to its input, so each call gets its own (cheap) instance instead of
+    concurrent requests feeding frames into one shared noise model
+    """
+    vad = webrtcvad.Vad(VAD_AGGRESSIVENESS)
+    frame_samples = 16000 * frame_ms // 1000
+    n_frames = len(audio_array) // frame_samples
+    pcm = (np.clip(audio_array[:n_frames * frame_samples], -1.0, 1.0) * 32767).astype(np.int16)
+    frames = pcm.reshape(n_frames, frame_samples)
+    return frame_ms * sum(vad.is_speech(frame.tobytes(), 16000) for frame in frames)
+
+def trim_silence(audio_array, frame_length=4096, hop_length=2048, threshold_db=-35):
+    """
+    Trim leading and trailing silence using framed RMS energy
+    Frames are strided views of the buffer (no copies) and their energies are one einsum reduction
+    """
+    if len(audio_array) < frame_length:
+        return audio_array
+    
+    frames = sliding_window_view(audio_array, frame_length)[::hop_length]
+    energy = np.einsum("ij,ij->i", frames, frames) / frame_length
+    
+    # Same criterion as power_to_db(rms**2, ref=max) > threshold_db, without the log
+    non_silent_frames = np.flatnonzero(energy > energy.max() * 10 ** (threshold_db / 10))
+    if len(non_silent_frames) == 0:
+        return audio_array
+    
+    start_sample = non_silent_frames[0] * hop_length
+    if non_silent_frames[-1] == len(energy) - 1:
+        # Keep the tail that does not fill a whole frame
+        end_sample = len(audio_array)
+    else:
+        end_sample = non_silent_frames[-1] * hop_length + frame_length
+    return audio_array[start_sample:end_sample]
+
+def split_windows(audio_array, frame_length=1600):
+    """
+    Split 16kHz audio into windows of at most 30s for decoding, cutting at low-energy points
+    Each cut is the quietest frame (100ms) of the window's last WINDOW_CUT_SEARCH_SAMPLES so
+    words are not split across windows, and the cut leaves at least MIN_WINDOW_SAMPLES for the
+    rest, so there is no short, mostly-padding tail window (which Whisper hallucinates on)
+    """
+    windows = []
+    start = 0
+    while len(audio_array) - start > CHUNK_SAMPLES:
+        search_end = min(start + CHUNK_SAMPLES, len(audio_array) - MIN_WINDOW_SAMPLES)
+        search_start = max(start + MIN_WINDOW_SAMPLES, search_end - WINDOW_CUT_SEARCH_SAMPLES)
+        region = audio_array[search_start:search_end]
+        n_frames = len(region) // frame_length
+        if n_frames == 0:
+            cut = search_end
+        else:
+            frames = region[:n_frames * frame_length].reshape(n_frames, frame_length)
+            energy = np.einsum("ij,ij->i", frames, frames)
+            cut = search_start + int(energy.argmin()) * frame_length + frame_length // 2
+        windows.append(audio_array[start:cut])
+        start = cut
+    windows.append(audio_array[start:])
+    return windows
+
+def preprocess_audio(audio_file_obj, file_format, out=None, with_features=True):
+    """
+    Decode an upload and prepare it for the model in one call (run in a worker thread, so
+    none of the per-sample work blocks the event loop): decode, resample to 16kHz, normalize,
+    trim silence, VAD gate, pad to the minimum length and, with with_features, one log-mel
+    window per 30s of audio
+    Returns (audio_array, windows); audio_array is None when the VAD found no speech
+    """
+    # Decode straight from the upload with soundfile (falls back to FFmpeg for compressed formats)
+    audio_array, original_sr = load_audio(audio_file_obj, file_format, out)
+    
+    # Resample to 16kHz if needed (Whisper requirement) with torchaudio's C++ polyphase kernel
+    if original_sr != 16000:
+        logger.debug(f"Resampling from {original_sr}Hz to 16000Hz")
+        audio_array = resample_to_16k(audio_array, original_sr)
+    
+    # Normalize audio to prevent clipping and improve quality
+    # Peak from two reductions (no |x| temporary), then a single in-place scaling pass
+    max_val = max(float(audio_array.max()), -float(audio_array.min()))
+    if max_val > 0.0:
+        # Scale peak to 95% to avoid clipping (audio_array is owned by this request)
+        np.multiply(audio_array, 0.95 / max_val, out=audio_array)
+    
+    # Remove silence at start and end (large frames for speed). Short clips - the common
+    # mobile upload - skip this: the encoder always sees a padded 30s window anyway
+    original_length = len(audio_array)
+    if original_length > SILENCE_TRIM_MIN_SAMPLES:
+        audio_array = trim_silence(audio_array)
+        if len(audio_array) < original_length:
+            logger.debug(f"Trimmed silence: {len(audio_array)} samples remaining")
+    
+    # Skip inference entirely for uploads without speech (encoder cost is the same for silence)
+    if webrtcvad is not None:
+        speech_ms = voiced_duration_ms(audio_array)
+        if speech_ms < VAD_MIN_SPEECH_MS:
+            logger.debug(f"No speech detected ({speech_ms} ms voiced), skipping transcription")
+            return None, None
+    
+    # Ensure minimum length (at least 0.5 seconds)
+    min_samples = int(16000 * 0.5)  # 0.5 seconds at 16kHz
+    if len(audio_array) < min_samples:
+        logger.warning(f"Audio too short ({len(audio_array)} samples), padding to minimum")
+        padding = np.zeros(min_samples - len(audio_array), dtype=np.float32)
+        audio_array = np.concatenate([padding, audio_array])
+    
+    # Keep the preprocessed audio in memory as a raw 16kHz float32 array
+    audio_array = audio_array.astype(np.float32, copy=False)
+    logger.debug(f"Preprocessed audio: {len(audio_array)} samples at 16kHz")
+    
+    if not with_features:
+        return audio_array, None
+    
+    # Audio longer than 30s is split into windows of up to 30s that are queued together,
+    # so they are decoded as one batch
+    segments = split_windows(audio_array)
+    if len(segments) > 1 and webrtcvad is not None:
+        # Windows without speech (pauses between verses) would only decode hallucinated text
+        voiced_segments = [
+            segment for segment in segments if voiced_duration_ms(segment) >= VAD_MIN_SPEECH_MS
+        ]
+        segments = voiced_segments or segments[:1]
+    windows = [compute_log_mel(segment) for segment in segments]
+    if len(windows) > 1:
+        logger.debug(f"Long audio: {len(windows)} windows of up to 30s")
+    return audio_array, windows
+
+def hub_revision():
+    """
+    Commit hash of MODEL_ID's main branch, asked from the Hub so new revisions are picked up
+    (at startup and by /reload-model); offline, the one recorded in the local hub cache, or None
+    """
+    try:
+        return HfApi().model_info(MODEL_ID, timeout=10).sha
+    except Exception as e:
+        logger.warning(f"Hub revision lookup failed, using the cached revision: {e}")
+    
+    ref_path = os.path.join(MODEL_CACHE_DIR, "models--" + MODEL_ID.replace("/", "--"), "refs", "main")
+    try:
+        with open(ref_path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def safetensors_model_dir(revision):
+    """
+    Local safetensors copy of the weights, written when the hub repo has only pickled weights
+    Keyed by hub revision and by dtype, as the copy is saved in the runtime dtype (WHISPER_DTYPE)
+    """
+    dtype_name = str(WHISPER_DTYPE).replace("torch.", "")
+    return os.path.join(
+        MODEL_CACHE_DIR, f"safetensors-{MODEL_ID.replace('/', '--')}-{revision[:12]}-{dtype_name}"
+    )
+
+def find_safetensors_weights(revision):
+    """Return the path of cached safetensors weights of a revision (local copy or hub cache), or None"""
+    if revision is not None:
+        local_weights = os.path.join(safetensors_model_dir(revision), "model.safetensors")
+        if os.path.exists(local_weights):
+            return local_weights
+    
+    hub_weights = try_to_load_from_cache(
+        MODEL_ID, "model.safetensors", cache_dir=MODEL_CACHE_DIR, revision=revision
+    )
+    return hub_weights if isinstance(hub_weights, str) else None
+
+def prefetch_cached_weights(weights_path):
+    """
+    Start kernel readahead of cached safetensors weights (from find_safetensors_weights())
+    before they are memory-mapped
+    No-op on first run (nothing cached yet) or on platforms without posix_fadvise
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    
+    if weights_path is None:
+        return
+    
+    fd = os.open(weights_path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+
+class EncoderForExport(torch.nn.Module):
+    """Whisper encoder returning only the last hidden state, for ONNX export"""
+    
+    def __init__(self, encoder):
+        super().__init__()
+        self.encoder = encoder
+    
+    def forward(self, input_features):
+        return self.encoder(input_features, return_dict=False)[0]
+
+def load_onnx_encoder():
+    """
+    Export the (fp32) encoder to ONNX once and open an ONNX Runtime session for it
+    ORT fuses the LayerNorm/GELU/attention subgraphs of the fixed-shape encoder
+    """
+    global encoder_session
+    
+    import onnxruntime as ort
+    
+    if not os.path.exists(ONNX_ENCODER_PATH):
+        logger.info("Exporting encoder to ONNX (first run only)...")
+        os.makedirs(os.path.dirname(ONNX_ENCODER_PATH), exist_ok=True)
+        example_features = torch.zeros((1, model.config.num_mel_bins, 3000))
+        torch.onnx.export(
+            EncoderForExport(model.model.encoder),
+            (example_features,),
+            ONNX_ENCODER_PATH,
+            input_names=["input_features"],
+            output_names=["last_hidden_state"],
+            dynamic_axes={"input_features": {0: "batch"}, "last_hidden_state": {0: "batch"}},
+            opset_version=17,
+        )
+    
+    session_options = ort.SessionOptions()
+    session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    session_options.intra_op_num_threads = NUM_THREADS
+    encoder_session = ort.InferenceSession(
+        ONNX_ENCODER_PATH, sess_options=session_options, providers=["CPUExecutionProvider"]
+    )
+    logger.info("✓ ONNX Runtime encoder session ready")
+
+def load_jit_encoder():
+    """
+    Trace the encoder with TorchScript, then freeze and optimize it for inference
+    The encoder input shape is fixed (30s log-mel), so the trace covers every request
+    """
+    global jit_encoder
+    
+    example_features = torch.zeros((1, model.config.num_mel_bins, 3000), dtype=model.dtype)
+    with torch.no_grad():
+        traced = torch.jit.trace(EncoderForExport(model.model.encoder).eval(), example_features)
+        jit_encoder = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+    logger.info("✓ TorchScript encoder ready")
+
+def apply_bettertransformer(model):
+    """Route attention through fused PyTorch kernels with optimum's BetterTransformer, if installed"""
+    try:
+        from optimum.bettertransformer import BetterTransformer
+        
+        model = BetterTransformer.transform(model)
+        logger.info("✓ BetterTransformer attention enabled")
+    except Exception as e:
+        logger.warning(f"BetterTransformer unavailable, using eager attention: {e}")
+    return model
+
+def warmup_model(max_new_tokens=MAX_NEW_TOKENS):
+    """
+    Run one full-length decode (max_new_tokens) on a silent 30s input
+    Uses the fixed input shape and full decode length so compiled graphs are captured for the
+    shapes live requests use, and the CUDA allocator pool is sized for inference. The pool is
+    deliberately not released with torch.cuda.empty_cache().
+    """
+    start_time = time.time()
+    batch_size = MAX_BATCH if TORCH_COMPILE else 1
+    warmup_features = torch.full(
+        (batch_size, model.config.num_mel_bins, 3000), SILENT_LOG_MEL, dtype=model.dtype, device=device
+    )
+    with inference_context():
+        model.generate(warmup_features, min_new_tokens=max_new_tokens, max_new_tokens=max_new_tokens)
+    logger.info(f"✓ Warm-up inference completed in {time.time() - start_time:.1f} seconds")
+
+def warmup_backend():
+    """
+    Run one silent 30s request through the ct2 / whispercpp / onnx backend
+    Native thread pools, kernels and allocators are initialized before the first live request
+    """
+    start_time = time.time()
+    silent_audio = np.zeros(16000 * 30, dtype=np.float32)
+    if WHISPER_BACKEND == "whispercpp":
+        whispercpp_model.transcribe(silent_audio, language="ar")
+    else:
+        generate_batch(compute_log_mel(silent_audio), ["ar"])
+    logger.info(f"✓ Warm-up inference completed in {time.time() - start_time:.1f} seconds")
+
+def warmup_preprocessing():
+    """
+    Build the per-request audio front-end state before the first upload: resamplers for the
+    usual phone rates (44.1/48 kHz), the on-device STFT (cuFFT plan on CUDA) and tokenizer decoding
+    """
+    start_time = time.time()
+    silent_audio = np.zeros(48000, dtype=np.float32)
+    for sample_rate in (44100, 48000):
+        resample_to_16k(silent_audio[:sample_rate], sample_rate)
+    if processor is not None:
+        compute_log_mel(silent_audio[:16000])
+        processor.batch_decode([[processor.tokenizer.eos_token_id]], skip_special_tokens=True)
+    logger.info(f"✓ Audio preprocessing warmed up in {(time.time() - start_time) * 1000:.0f} ms")
+
+def compile_cache_path():
+    """torch.compile artifact file, keyed by torch version and device (artifacts are not portable)"""
+    device_name = torch.cuda.get_device_name(0) if device == "cuda" else "cpu"
+    key = f"{torch.__version__}-{device_name}".replace(" ", "_").replace("/", "_")
+    return os.path.join(MODEL_CACHE_DIR, f"torch_compile_cache-{key}.bin")
+
+def load_compile_cache():
+    """Preload saved torch.compile artifacts so Dynamo/Inductor/Triton work is skipped on restart"""
+    path = compile_cache_path()
+    if not hasattr(torch.compiler, "load_cache_artifacts") or not os.path.exists(path):
+        return
+    try:
+        with open(path, "rb") as f:
+            torch.compiler.load_cache_artifacts(f.read())
+        logger.info(f"✓ Loaded torch.compile artifacts from {path}")
+    except Exception as e:
+        logger.warning(f"Ignoring unusable torch.compile artifacts: {e}")
+
+def save_compile_cache():
+    """
+    Save the torch.compile artifacts produced by the warm-up for the next start
+    Failures (read-only or full cache dir) only cost the next start a recompile
+    """
+    if not hasattr(torch.compiler, "save_cache_artifacts"):
+        return
+    try:
+        artifacts = torch.compiler.save_cache_artifacts()
+        if artifacts is None:
+            return
+        artifact_bytes, _ = artifacts
+        with open(compile_cache_path(), "wb") as f:
+            f.write(artifact_bytes)
+    except Exception as e:
+        logger.warning(f"Could not save torch.compile artifacts: {e}")
+
+def compile_model():
+    """
+    Compile the model forward pass with a static KV cache
+    Each decoding step then replays one captured graph instead of launching eager kernels
+    """
+    global model, model_compiled
+    
+    try:
+        logger.info("Compiling model with torch.compile (reduce-overhead)...")
+        load_compile_cache()
+        model.generation_config.cache_implementation = "static"
+        model.generation_config.max_new_tokens = MAX_NEW_TOKENS
+        model.forward = torch.compile(model.forward, mode="reduce-overhead", fullgraph=True)
+        
+        # Capture the graphs for every allowed decoding length now rather than on live requests
+        for max_new_tokens in COMPILED_DECODE_LENGTHS:
+            warmup_model(max_new_tokens)
+        model_compiled = True
+        logger.info("✓ Model compiled")
+    except Exception as e:
+        logger.warning(f"torch.compile failed, falling back to eager mode: {e}")
+        model_compiled = False
+        model.__dict__.pop("forward", None)
+        model.generation_config.cache_implementation = None
+        return
+    
+    save_compile_cache()
+
+def configure_generation(generation_config):
+    """
+    Fix the decoder prompt (Arabic transcription) on the generation config once at load time
+    The checkpoint's forced_decoder_ids are dropped: generate() builds the prompt from
+    language/task, and per-request languages are passed only when they differ
+    Legacy generation configs (no lang_to_id) get the Arabic prompt as forced_decoder_ids
+    """
+    if not hasattr(generation_config, "lang_to_id"):
+        generation_config.forced_decoder_ids = processor.get_decoder_prompt_ids(
+            language="ar", task="transcribe"
+        )
+        return
+    generation_config.language = "ar"
+    generation_config.task = "transcribe"
+    generation_config.forced_decoder_ids = None
+
+def load_processor():
+    """
+    Load the Whisper processor (feature extractor + tokenizer)
+    Its mel filter bank and STFT window are cached on device for compute_log_mel()
+    """
+    global processor, mel_frontend, language_token_ids
+    
+    new_processor = WhisperProcessor.from_pretrained(
+        MODEL_ID,
+        cache_dir=MODEL_CACHE_DIR,
+    )
+    
+    feature_extractor = new_processor.feature_extractor
+    mel_filters = torch.from_numpy(feature_extractor.mel_filters).to(device, torch.float32)
+    stft_window = torch.hann_window(feature_extractor.n_fft, device=device)
+    # ct2/onnx take float32 features; the PyTorch model is loaded before this and sets its dtype
+    features_dtype = model.dtype if model is not None else torch.float32
+    mel_frontend = (feature_extractor, mel_filters, stft_window, features_dtype)
+    tokenizer = new_processor.tokenizer
+    token_ids = {code: tokenizer.convert_tokens_to_ids(f"<|{code}|>") for code in LANGUAGES}
+    # Tokenizers of models trained on fewer languages map the missing tokens to unk
+    language_token_ids = {
+        code: token_id for code, token_id in token_ids.items()
+        if token_id is not None and token_id != tokenizer.unk_token_id
+    }
+    processor = new_processor
+    logger.info("✓ Mel filter bank cached on device")
+
+def load_ct2_model():
+    """
+    Load the model with faster-whisper (CTranslate2 backend)
+    The HF checkpoint is converted to CTranslate2 format once and cached on disk
+    """
+    global ct2_model, model_loaded
+    
+    from faster_whisper import WhisperModel
+    
+    if not os.path.exists(os.path.join(CT2_MODEL_DIR, "model.bin")):
+        from ctranslate2.converters import TransformersConverter
+        
+        logger.info(f"Converting {MODEL_ID} to CTranslate2 format (first run only)...")
+        source_dir = snapshot_download(MODEL_ID, cache_dir=MODEL_CACHE_DIR)
+        copy_files = [
+            name for name in ("tokenizer.json", "preprocessor_config.json")
+            if os.path.exists(os.path.join(source_dir, name))
+        ]
+        TransformersConverter(source_dir, copy_files=copy_files).convert(
+            CT2_MODEL_DIR, quantization="float16", force=True
+        )
+        logger.info(f"✓ Converted model saved to {CT2_MODEL_DIR}")
+    
+    compute_type = CT2_COMPUTE_TYPE or ("int8" if device == "cpu" else "int8_float16")
+    ct2_model = WhisperModel(
+        CT2_MODEL_DIR,
+        device=device,
+        compute_type=compute_type,
+        cpu_threads=NUM_THREADS,
+        num_workers=1,
+    )
+    model_loaded = True
+    
+    logger.info(f"✓ faster-whisper model loaded ({compute_type}) on {device}")
+
+def load_whispercpp_model():
+    """
+    Load a quantized ggml model with whisper.cpp (pywhispercpp bindings)
+    Create the model once with convert_and_quantize.sh
+    """
+    global whispercpp_model, model_loaded
+    
+    from pywhispercpp.model import Model
+    
+    if not os.path.exists(WHISPERCPP_MODEL):
+        raise FileNotFoundError(
+            f"whisper.cpp model not found: {WHISPERCPP_MODEL} (run ./convert_and_quantize.sh first)"
+        )
+    
+    if WHISPERCPP_MODEL_SHA256:
+        actual_sha256 = file_sha256(WHISPERCPP_MODEL)
+        if actual_sha256 != WHISPERCPP_MODEL_SHA256.lower():
+            raise RuntimeError(
+                f"whisper.cpp model digest mismatch: {WHISPERCPP_MODEL} has sha256 {actual_sha256}, "
+                f"expected {WHISPERCPP_MODEL_SHA256}"
+            )
+    
+    whispercpp_model = Model(
+        WHISPERCPP_MODEL,
+        n_threads=NUM_THREADS,
+        print_realtime=False,
+        print_progress=False,
+    )
+    model_loaded = True
+    
+    logger.info(f"✓ whisper.cpp model loaded: {WHISPERCPP_MODEL}")
+
+def load_ort_model():
+    """
+    Load the INT4 ONNX model with ONNX Runtime (optimum)
+    Create the model once with export_onnx_int4.py
+    """
+    global ort_model, model_loaded
+    
+    import onnxruntime as ort
+    from optimum.onnxruntime import ORTModelForSpeechSeq2Seq
+    
+    if not os.path.isdir(ONNX_MODEL_DIR):
+        raise FileNotFoundError(
+            f"ONNX model not found: {ONNX_MODEL_DIR} (run python export_onnx_int4.py first)"
+        )
+    
+    session_options = ort.SessionOptions()
+    session_options.intra_op_num_threads = NUM_THREADS
+    session_options.inter_op_num_threads = 1
+    session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    ort_model = ORTModelForSpeechSeq2Seq.from_pretrained(
+        ONNX_MODEL_DIR,
+        provider="CPUExecutionProvider",
+        session_options=session_options,
+        use_io_binding=False,
+    )
+    configure_generation(ort_model.generation_config)
+    model_loaded = True
+    
+    logger.info(f"✓ ONNX Runtime model loaded: {ONNX_MODEL_DIR}")
 
 def download_and_load_model():
     """
     Download model from Hugging Face and load into memory
     Model is cached on disk after first download
     """
-    global model, processor, pipe, model_loaded
+    global model, model_loaded
     
     if model_loaded:
         logger.info("Model already loaded")
         return
     
     try:
-        from transformers import WhisperProcessor, WhisperForConditionalGeneration
-        from transformers import pipeline as transformers_pipeline
-        
         logger.info(f"Loading model: {MODEL_ID}")
+        logger.info(f"Backend: {WHISPER_BACKEND}")
+        if WHISPER_BACKEND == "transformers":
+            logger.info(f"Attention: {ATTN_IMPLEMENTATION}")
         logger.info(f"Device: {device}")
         logger.info(f"Cache directory: {MODEL_CACHE_DIR}")
         
-        # Create cache directory
-        os.makedirs(MODEL_CACHE_DIR, exist_ok=True)
+        # Create cache directory (first run only)
+        if not os.path.isdir(MODEL_CACHE_DIR):
+            os.makedirs(MODEL_CACHE_DIR, exist_ok=True)
+        
+        if WHISPER_BACKEND == "ct2":
+            load_processor()
+            load_ct2_model()
+        elif WHISPER_BACKEND == "whispercpp":
+            load_whispercpp_model()
+        elif WHISPER_BACKEND == "onnx":
+            load_processor()
+            load_ort_model()
+        if model_loaded:
+            # One of the non-PyTorch backends above was loaded
+            if WARMUP:
+                warmup_backend()
+                warmup_preprocessing()
+            return
         
         # Download and load model from Hugging Face
         # This will download on first run and cache for subsequent runs
         logger.info("Downloading model from Hugging Face (this may take a few minutes on first run)...")
         
-        model = WhisperForConditionalGeneration.from_pretrained(
-            MODEL_ID,
+        # One lookup of the cached weights serves the readahead and the choice of source; a new
+        # hub revision has no cached weights yet, so it is downloaded instead of the old copy
+        revision = hub_revision()
+        local_copy_dir = safetensors_model_dir(revision) if revision is not None else None
+        cached_weights = find_safetensors_weights(revision)
+        prefetch_cached_weights(cached_weights)
+        
+        # safetensors weights (preferred when the repo has them) are memory-mapped, and
+        # low_cpu_mem_usage skips the random init + copy of a full fp32 model
+        use_local_copy = local_copy_dir is not None and cached_weights == os.path.join(
+            local_copy_dir, "model.safetensors"
+        )
+        load_kwargs = {}
+        if device == "cuda" and WHISPER_QUANT == "int8":
+            from transformers import QuantoConfig
+            
+            # int8 weights on the GPU (activations stay fp16): half the weight memory and bandwidth
+            load_kwargs["quantization_config"] = QuantoConfig(weights="int8")
+        load_kwargs.update(
             cache_dir=MODEL_CACHE_DIR,
-            torch_dtype=torch.float16 if device == "cuda" else torch.float32,
+            torch_dtype=WHISPER_DTYPE,
             device_map="auto" if device == "cuda" else None,
+            low_cpu_mem_usage=True,
         )
+        if not use_local_copy:
+            load_kwargs["revision"] = revision or "main"
+        model_source = local_copy_dir if use_local_copy else MODEL_ID
+        # Step down flash_attention_2 -> sdpa -> eager when an implementation can't be used
+        # (flash-attn not importable, or a transformers release without SDPA for Whisper)
+        attn_fallbacks = ["flash_attention_2", "sdpa", "eager"]
+        if ATTN_IMPLEMENTATION in attn_fallbacks:
+            attn_candidates = attn_fallbacks[attn_fallbacks.index(ATTN_IMPLEMENTATION):]
+        else:
+            attn_candidates = [ATTN_IMPLEMENTATION, "sdpa", "eager"]
+        for attn_implementation in attn_candidates:
+            try:
+                model = WhisperForConditionalGeneration.from_pretrained(
+                    model_source, attn_implementation=attn_implementation, **load_kwargs
+                )
+                break
+            except (ValueError, ImportError) as e:
+                # Only attention-implementation errors fall through to the next candidate
+                if attn_implementation == "eager" or not any(
+                    marker in str(e).lower() for marker in ("attention", "attn", "flash")
+                ):
+                    raise
+                logger.warning(f"{attn_implementation} attention unavailable, falling back: {e}")
+        # Only re-checked when nothing was cached before (first run, weights just downloaded);
+        # quantized models can't be saved back as plain safetensors
+        if (
+            cached_weights is None
+            and local_copy_dir is not None
+            and "quantization_config" not in load_kwargs
+            and find_safetensors_weights(revision) is None
+        ):
+            # The hub repo only ships pickled weights: keep a safetensors copy so restarts,
+            # /reload-model and other worker processes mmap it (sharing the page cache)
+            logger.info(f"Saving safetensors copy of the weights to {local_copy_dir}")
+            model.save_pretrained(local_copy_dir, safe_serialization=True)
         
-        processor = WhisperProcessor.from_pretrained(
-            MODEL_ID,
-            cache_dir=MODEL_CACHE_DIR,
-        )
+        if attn_implementation == "eager" and ATTN_IMPLEMENTATION != "eager":
+            # Neither fused kernel is available: try BetterTransformer's fused attention. Only
+            # after the safetensors copy - BetterTransformer makes save_pretrained() raise
+            model = apply_bettertransformer(model)
+        
+        load_processor()
+        configure_generation(model.generation_config)
         
         # Move to device if CPU
         if device == "cpu":
             model = model.to(device)
         
+        model.eval()
+        
+        # Export before quantization: the ONNX encoder is built from the fp32 weights
+        if ONNX_ENCODER:
+            try:
+                load_onnx_encoder()
+            except Exception as e:
+                logger.warning(f"ONNX encoder unavailable, using PyTorch encoder: {e}")
+        
         # Optimize model for faster CPU inference
-        if device == "cpu":
+        if device == "cpu" and WHISPER_QUANT == "int8" and WHISPER_DTYPE == torch.float32:
             logger.info("Optimizing model for CPU inference...")
             try:
-                # Use torch.jit.script or torch.compile for faster inference
-                # Note: Some models may not support JIT compilation
-                # For now, we'll rely on other optimizations
-                # Model is already in eval mode, which helps
-                logger.info("✓ Model optimized for CPU")
+                # Dynamic int8 quantization of the Linear layers: decoder matmuls are
+                # memory-bound on CPU, int8 weights halve the bytes moved and use VNNI kernels
+                model = tq.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+                q_proj = model.model.decoder.layers[0].self_attn.q_proj
+                logger.info(f"✓ Model quantized to int8 ({type(q_proj).__name__})")
             except Exception as e:
                 logger.warning(f"Optimization note: {e}")
         
-        model.eval()
+        # After quantization, so the frozen graph uses the int8 Linear kernels
+        if JIT_ENCODER and encoder_session is None:
+            try:
+                load_jit_encoder()
+            except Exception as e:
+                logger.warning(f"TorchScript encoder unavailable, using eager encoder: {e}")
         
-        # Create and cache pipeline for faster inference
-        from transformers import pipeline
-        global pipe
-        pipe = pipeline(
-            "automatic-speech-recognition",
-            model=model,
-            tokenizer=processor.tokenizer,
-            feature_extractor=processor.feature_extractor,
-            device=0 if device == "cuda" else -1,
-            return_timestamps=False,
-        )
-        logger.info("✓ Pipeline created and cached")
+        if TORCH_COMPILE:
+            compile_model()  # Always warms up: the graphs are captured on the first call
+        elif WARMUP:
+            warmup_model()
+        if WARMUP:
+            warmup_preprocessing()
         
         model_loaded = True
         
@@ -124,7 +1327,7 @@ def download_and_load_model():
         
     except ImportError as e:
         logger.error(f"Missing dependency: {e}")
-        logger.error("Install with: pip install transformers torch torchaudio")
+        logger.error("Install with: pip install -r requirements.txt (backends and extras: requirements-optional.txt)")
         raise
     except Exception as e:
         logger.error(f"Failed to load model: {e}", exc_info=True)
@@ -136,6 +1339,22 @@ async def startup_event():
     logger.info("=" * 60)
     logger.info("Starting Whisper Arabic Transcription Server")
     logger.info("=" * 60)
+    
+    global pending_requests, batch_worker_task, model_lock, request_slots, redis_client
+    pending_requests = asyncio.Queue()
+    model_lock = asyncio.Lock()
+    request_slots = asyncio.Semaphore(MAX_INFLIGHT)
+    batch_worker_task = asyncio.create_task(batch_worker())
+    
+    if REDIS_URL:
+        try:
+            import redis.asyncio as redis
+            
+            redis_client = redis.from_url(REDIS_URL)
+            logger.info("✓ Redis transcription cache enabled")
+        except ImportError as e:
+            logger.warning(f"Redis cache disabled, missing dependency: {e}")
+    
     try:
         download_and_load_model()
     except Exception as e:
@@ -145,30 +1364,94 @@ async def startup_event():
 @app.get("/")
 async def root():
     """Health check endpoint"""
-    return {
-        "status": "online",
-        "service": "Whisper Arabic Transcription API",
-        "model_loaded": model_loaded,
-        "device": device,
-        "model_id": MODEL_ID
-    }
+    # Probes hit this constantly: the body only depends on model_loaded, so it is encoded once
+    key = ("root", model_loaded)
+    payload = _status_payloads.get(key)
+    if payload is None:
+        payload = _status_payloads[key] = orjson.dumps({
+            "status": "online",
+            "service": "Whisper Arabic Transcription API",
+            "model_loaded": model_loaded,
+            "device": device,
+            "backend": WHISPER_BACKEND,
+            "model_id": MODEL_ID
+        })
+    return Response(payload, media_type="application/json")
 
 @app.get("/health")
 async def health():
     """Detailed health check"""
-    return {
-        "status": "healthy" if model_loaded else "degraded",
-        "model_loaded": model_loaded,
-        "processor_loaded": processor is not None,
-        "device": device,
-        "model_id": MODEL_ID,
-        "cache_dir": MODEL_CACHE_DIR
+    key = ("health", model_loaded, processor is not None)
+    payload = _status_payloads.get(key)
+    if payload is None:
+        payload = _status_payloads[key] = orjson.dumps({
+            "status": "healthy" if model_loaded else "degraded",
+            "model_loaded": model_loaded,
+            "processor_loaded": processor is not None,
+            "device": device,
+            "backend": WHISPER_BACKEND,
+            "model_id": MODEL_ID,
+            "cache_dir": MODEL_CACHE_DIR
+        })
+    return Response(payload, media_type="application/json")
+
+def finish_request(inflight_key):
+    """
+    Release the request's MAX_INFLIGHT slot and wake duplicates that waited on it
+    (with None when it failed - they then transcribe on their own)
+    """
+    request_slots.release()
+    if inflight_key is not None:
+        future = _inflight_transcriptions.pop(inflight_key, None)
+        if future is not None and not future.done():
+            future.set_result(None)
+
+def transcription_response(text, language, stream):
+    """The transcription result as JSON, or as a single NDJSON line for ?stream=true"""
+    payload = {
+        "success": True,
+        "text": text,
+        "language": language,
+        "model": MODEL_ID
     }
+    if stream:
+        # Same framing as stream_transcription(): the result is the last (here the only) line
+        return Response(orjson.dumps(payload) + b"\n", media_type="application/x-ndjson")
+    return ORJSONResponse(payload)
+
+async def stream_transcription(futures, cache_key, language, inflight_key):
+    """
+    Yield one NDJSON line per decoded 30s window, then the complete result
+    The request holds its MAX_INFLIGHT slot until the stream ends
+    """
+    try:
+        texts = []
+        for index, future in enumerate(futures):
+            text = (await future).strip()
+            texts.append(text)
+            yield orjson.dumps({"index": index, "text": text}) + b"\n"
+        
+        transcribed_text = " ".join(texts)
+        await cache_transcription(cache_key, transcribed_text)
+        yield orjson.dumps({
+            "success": True,
+            "text": transcribed_text,
+            "language": language,
+            "model": MODEL_ID
+        }) + b"\n"
+    except Exception as e:
+        logger.error(f"Transcription error: {e}", exc_info=True)
+        yield orjson.dumps({"success": False, "detail": f"Transcription failed: {str(e)}"}) + b"\n"
+    finally:
+        finish_request(inflight_key)
 
 @app.post("/transcribe")
 async def transcribe_audio(
     file: UploadFile = File(...),
-    language: Optional[str] = "ar"
+    language: Optional[str] = "ar",
+    beam_size: int = Query(1, ge=1, le=MAX_BEAM_SIZE),
+    max_new_tokens: int = Query(MAX_NEW_TOKENS, ge=1, le=MAX_NEW_TOKENS_LIMIT),
+    stream: bool = False
 ):
     """
     Transcribe audio file to Arabic text
@@ -176,162 +1459,165 @@ async def transcribe_audio(
     Args:
         file: Audio file (WAV, MP3, M4A, etc.) - should be ≤10 seconds
         language: Language code (default: "ar" for Arabic)
+        beam_size: Beam search width (default: 1, greedy). Larger beams are several times
+            slower - only worth it for offline transcription where accuracy matters most
+        max_new_tokens: Decoding length limit per 30s window (default: 120). Lower values cap
+            latency for short clips, higher ones avoid truncating fast dense recitation
+        stream: Return NDJSON instead: one line per 30s window as it is decoded, then the
+            usual JSON result as the last line
     
     Returns:
         JSON with transcribed text
     """
-    if not model_loaded or model is None or processor is None:
+    if not model_loaded:
         raise HTTPException(
             status_code=503,
             detail="Model not loaded. Please check server logs and wait for model to load."
         )
     
     # Validate file type
-    allowed_extensions = {'.wav', '.mp3', '.m4a', '.ogg', '.flac', '.webm', '.mpeg', '.mp4'}
-    file_ext = Path(file.filename or "audio.wav").suffix.lower()
-    if file_ext not in allowed_extensions:
+    _, dot, ext = (file.filename or "audio.wav").rpartition(".")
+    file_ext = "." + ext.lower() if dot else ""
+    if file_ext not in ALLOWED_EXTENSIONS:
         raise HTTPException(
             status_code=400,
-            detail=f"Unsupported file type: {file_ext}. Allowed: {', '.join(allowed_extensions)}"
+            detail=f"Unsupported file type: {file_ext}. Allowed: {', '.join(ALLOWED_EXTENSIONS)}"
         )
     
-    # Save uploaded file to temporary location
-    tmp_file_path = None
+    if model_compiled:
+        # Only the captured shapes: greedy decoding at one of the compiled decoding lengths
+        if beam_size > 1:
+            raise HTTPException(
+                status_code=400,
+                detail="beam_size > 1 is not available while the model is compiled (TORCH_COMPILE=1)"
+            )
+        max_new_tokens = next(length for length in COMPILED_DECODE_LENGTHS if length >= max_new_tokens)
+    
+    # Validate language: an unknown code would fail generate() for the whole micro-batch
+    if language and language not in LANGUAGES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unsupported language: {language}. Use a Whisper language code such as \"ar\""
+        )
+    
+    await request_slots.acquire()
+    scratch_buffer = acquire_scratch_buffer()
+    inflight_key = None  # Set when this request is the one transcribing its upload
+    streaming = False  # The StreamingResponse releases the slot when the stream ends
     try:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=file_ext) as tmp_file:
-            content = await file.read()
-            
-            # Check file size (warn if > 10 seconds worth of audio)
-            file_size_mb = len(content) / (1024 * 1024)
-            if file_size_mb > 1.0:  # Rough estimate for 10s audio
-                logger.warning(f"Large audio file detected: {file_size_mb:.2f} MB")
-            
-            tmp_file.write(content)
-            tmp_file_path = tmp_file.name
+        # Hash in chunks off the event loop (the spooled upload may have rolled over to disk)
+        digest, upload_size = await asyncio.to_thread(hash_upload, file.file)
+        if upload_size > MAX_UPLOAD_BYTES:
+            # Chunked uploads carry no Content-Length for the middleware to check
+            raise HTTPException(
+                status_code=413,
+                detail=f"Upload too large (limit {MAX_UPLOAD_BYTES // (1024 * 1024)} MB)"
+            )
+        
+        # Identical uploads (app retries, repeated verses) are answered from the cache
+        cache_key = digest + f"{language or ''}:{beam_size}:{max_new_tokens}".encode()
+        cached_text = await get_cached_transcription(cache_key)
+        if cached_text is None and cache_key in _inflight_transcriptions:
+            # The same upload is being transcribed right now: share that result (None if it failed)
+            cached_text = await asyncio.shield(_inflight_transcriptions[cache_key])
+        elif cached_text is None:
+            _inflight_transcriptions[cache_key] = asyncio.get_running_loop().create_future()
+            inflight_key = cache_key
+        if cached_text is not None:
+            logger.debug(f"Transcription cache hit: {file.filename} ({upload_size} bytes)")
+            return transcription_response(cached_text, language, stream)
+        
+        # Check file size (warn if > 10 seconds worth of audio)
+        file_size_mb = upload_size / (1024 * 1024)
+        if file_size_mb > 1.0:  # Rough estimate for 10s audio
+            logger.warning(f"Large audio file detected: {file_size_mb:.2f} MB")
         
-        logger.info(f"Transcribing audio: {file.filename} ({len(content)} bytes)")
+        logger.debug(f"Transcribing audio: {file.filename} ({upload_size} bytes)")
         
         # Audio preprocessing for better accuracy
-        import librosa
-        import numpy as np
-        from scipy.io import wavfile
-        
-        logger.info("Preprocessing audio...")
-        
-        # Load audio with librosa (handles various formats)
-        audio_array, original_sr = librosa.load(tmp_file_path, sr=None, mono=True)
-        
-        # Resample to 16kHz if needed (Whisper requirement)
-        if original_sr != 16000:
-            logger.info(f"Resampling from {original_sr}Hz to 16000Hz")
-            audio_array = librosa.resample(audio_array, orig_sr=original_sr, target_sr=16000)
-        
-        # Normalize audio to prevent clipping and improve quality
-        max_val = np.abs(audio_array).max()
-        if max_val > 0:
-            # Normalize to [-1, 1] range, but avoid over-amplification
-            if max_val < 1.0:
-                audio_array = audio_array / max_val * 0.95  # Scale to 95% to avoid clipping
-            else:
-                audio_array = audio_array / max_val * 0.95
-        
-        # Remove silence at start and end (optimized for speed)
-        # Use faster RMS-based detection with larger frames
-        frame_length = 4096  # Larger frames for faster processing
-        hop_length = 2048   # Larger hops for speed
-        threshold_db = -35  # Slightly higher threshold for faster detection
-        
-        # Calculate energy (faster with larger frames)
-        energy = librosa.feature.rms(y=audio_array, frame_length=frame_length, hop_length=hop_length)[0]
-        energy_db = librosa.power_to_db(energy**2, ref=np.max)
-        
-        # Find non-silent frames
-        non_silent_frames = np.where(energy_db > threshold_db)[0]
-        
-        if len(non_silent_frames) > 0:
-            # Convert frame indices to sample indices
-            start_frame = non_silent_frames[0]
-            end_frame = non_silent_frames[-1]
-            start_sample = start_frame * hop_length
-            end_sample = min((end_frame + 1) * hop_length, len(audio_array))
-            
-            # Trim silence
-            audio_array = audio_array[start_sample:end_sample]
-            logger.info(f"Trimmed silence: {len(audio_array)} samples remaining")
-        
-        # Ensure minimum length (at least 0.5 seconds)
-        min_samples = int(16000 * 0.5)  # 0.5 seconds at 16kHz
-        if len(audio_array) < min_samples:
-            logger.warning(f"Audio too short ({len(audio_array)} samples), padding to minimum")
-            padding = np.zeros(min_samples - len(audio_array))
-            audio_array = np.concatenate([padding, audio_array])
-        
-        # Save preprocessed audio to temporary file
-        preprocessed_path = tmp_file_path.replace(file_ext, '_preprocessed.wav')
-        wavfile.write(preprocessed_path, 16000, (audio_array * 32767).astype(np.int16))
-        logger.info(f"Preprocessed audio saved: {len(audio_array)} samples at 16kHz")
-        
-        # Use cached pipeline (created at startup) for faster inference
-        global pipe
-        if pipe is None:
-            logger.warning("Pipeline not cached, creating new one...")
-            from transformers import pipeline
-            pipe = pipeline(
-                "automatic-speech-recognition",
-                model=model,
-                tokenizer=processor.tokenizer,
-                feature_extractor=processor.feature_extractor,
-                device=0 if device == "cuda" else -1,
-                return_timestamps=False,
-            )
+        logger.debug("Preprocessing audio...")
+        
+        # Decoding and all per-sample preprocessing run in a worker thread so the event loop
+        # keeps accepting uploads meanwhile; whisper.cpp computes its own features
+        audio_array, windows = await asyncio.to_thread(
+            preprocess_audio,
+            file.file,
+            file_ext.lstrip("."),
+            scratch_buffer,
+            WHISPER_BACKEND != "whispercpp",
+        )
+        if audio_array is None:
+            await cache_transcription(cache_key, "")
+            return transcription_response("", language, stream)
         
-        # Transcribe - for fine-tuned Arabic model, we don't need to force language
-        # The model is already trained for Arabic, so it will transcribe in Arabic
-        logger.info(f"Running transcription (model: {MODEL_ID})...")
-        logger.info(f"Starting pipeline inference...")
+        # Transcribe - Arabic is fixed on the generation config at load time; other
+        # languages are passed to generate() per request
+        logger.debug(f"Running transcription (model: {MODEL_ID}, backend: {WHISPER_BACKEND})...")
         
-        # Use generate_kwargs for optimization
-        import time
         start_time = time.time()
         
-        result = pipe(
-            preprocessed_path,  # Use preprocessed audio
-            generate_kwargs={
-                "max_new_tokens": 120,  # Further reduced for faster generation
-                "num_beams": 1,  # Greedy decoding for speed
-                "do_sample": False,  # Deterministic
-                "temperature": None,  # Disable temperature for faster generation
-                "use_cache": True,  # Enable KV cache for faster generation
-            }
-        )
+        if WHISPER_BACKEND == "whispercpp":
+            async with model_lock:
+                # whisper.cpp releases the GIL; run it in a thread so the event loop stays responsive
+                segments = await run_inference(
+                    whispercpp_model.transcribe, audio_array, language=language or "ar"
+                )
+            result = {"text": "".join(segment.text for segment in segments)}
+        else:
+            # Features are computed on device, so the model is called directly instead of
+            # going through the pipeline (which would re-run the numpy feature extractor)
+            # Decoding is batched with other in-flight requests by batch_worker() - for the
+            # transformers, CTranslate2 and ONNX backends
+            
+            # Optionally reject audio in another language before paying for a full decode
+            if LANGUAGE_CHECK and WHISPER_BACKEND == "transformers" and language:
+                async with model_lock:
+                    detected_language, language_prob = await run_inference(
+                        detect_language, windows[0], language
+                    )
+                if detected_language != language and language_prob < LANGUAGE_CHECK_MIN_PROB:
+                    raise HTTPException(
+                        status_code=422,
+                        detail=f"Detected language {detected_language}, expected {language}"
+                    )
+            
+            loop = asyncio.get_running_loop()
+            futures = []
+            for input_features in windows:
+                future = loop.create_future()
+                await pending_requests.put(
+                    (input_features, language or "ar", (beam_size, max_new_tokens), future)
+                )
+                futures.append(future)
+            
+            if stream:
+                # Windows are decoded by the batch worker; the response streams them as they finish
+                streaming = True
+                return StreamingResponse(
+                    stream_transcription(futures, cache_key, language, inflight_key),
+                    media_type="application/x-ndjson"
+                )
+            texts = await asyncio.gather(*futures)
+            result = {"text": " ".join(text.strip() for text in texts)}
         
         elapsed_time = time.time() - start_time
-        logger.info(f"Pipeline inference completed in {elapsed_time:.2f} seconds")
+        logger.debug(f"Inference completed in {elapsed_time:.2f} seconds")
         
         transcribed_text = result.get("text", "").strip()
-        logger.info(f"Transcription result: {transcribed_text[:100]}...")
-        logger.info(f"Transcription result length: {len(transcribed_text)} characters")
-        
-        # Clean up preprocessed file
-        try:
-            if os.path.exists(preprocessed_path):
-                os.unlink(preprocessed_path)
-        except Exception as e:
-            logger.warning(f"Failed to delete preprocessed file: {e}")
+        logger.debug(f"Transcription result: {transcribed_text[:100]}...")
+        logger.debug(f"Transcription result length: {len(transcribed_text)} characters")
         
         if not transcribed_text:
             logger.warning("Empty transcription result")
             transcribed_text = ""
         
-        logger.info(f"✓ Transcription successful: {transcribed_text[:100]}...")
+        logger.info(f"✓ Transcription successful in {elapsed_time:.2f}s: {transcribed_text[:100]}")
+        await cache_transcription(cache_key, transcribed_text)
         
-        return JSONResponse({
-            "success": True,
-            "text": transcribed_text,
-            "language": language,
-            "model": MODEL_ID
-        })
+        return transcription_response(transcribed_text, language, stream)
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Transcription error: {e}", exc_info=True)
         raise HTTPException(
@@ -339,33 +1625,38 @@ async def transcribe_audio(
             detail=f"Transcription failed: {str(e)}"
         )
     finally:
-        # Clean up temporary files
-        if tmp_file_path and os.path.exists(tmp_file_path):
-            try:
-                os.unlink(tmp_file_path)
-            except Exception as e:
-                logger.warning(f"Failed to delete temp file: {e}")
-        
-        # Clean up preprocessed file if it exists
-        if tmp_file_path:
-            preprocessed_path = tmp_file_path.replace(Path(tmp_file_path).suffix, '_preprocessed.wav')
-            if os.path.exists(preprocessed_path):
-                try:
-                    os.unlink(preprocessed_path)
-                except Exception as e:
-                    logger.warning(f"Failed to delete preprocessed file: {e}")
+        # The features are already computed, so the scratch buffer is free even when streaming
+        release_scratch_buffer(scratch_buffer)
+        if not streaming:
+            finish_request(inflight_key)
 
 @app.post("/reload-model")
 async def reload_model():
     """Manually reload the model (useful for updates)"""
-    global model, processor, model_loaded
+    global model, ct2_model, encoder_session, jit_encoder, whispercpp_model, ort_model, model_loaded
+    global model_compiled
     
     try:
-        model = None
-        processor = None
-        model_loaded = False
-        
-        download_and_load_model()
+        # Wait for the in-flight decode to finish; queued requests then run on the new model
+        async with model_lock:
+            # The processor and mel front-end stay in place: requests already past the
+            # model_loaded check keep preprocessing with them until load_processor() swaps them
+            model = None
+            encoder_session = None
+            jit_encoder = None
+            whispercpp_model = None
+            ct2_model = None
+            ort_model = None
+            model_loaded = False
+            model_compiled = False
+            
+            # Release the old weights before loading the new ones (no two copies on the GPU)
+            gc.collect()
+            if device == "cuda":
+                torch.cuda.empty_cache()
+            
+            # Load off the event loop so health checks and uploads are still served meanwhile
+            await asyncio.to_thread(download_and_load_model)
         
         return {
             "success": True,
@@ -382,5 +1673,20 @@ if __name__ == "__main__":
     host = os.getenv("HOST", "0.0.0.0")
     port = int(os.getenv("PORT", 8000))
     
-    logger.info(f"Starting server on {host}:{port}")
-    uvicorn.run(app, host=host, port=port)
+    # uvloop event loop and httptools parser (both from uvicorn[standard]); no per-request
+    # access log lines unless ACCESS_LOG=1
+    server_options = dict(
+        host=host,
+        port=port,
+        loop="uvloop",
+        http="httptools",
+        access_log=os.getenv("ACCESS_LOG", "0") == "1",
+    )
+    
+    logger.info(f"Starting server on {host}:{port} ({WORKERS} worker(s))")
+    if WORKERS > 1:
+        # Each worker process imports main and loads its own copy of the model; the weights
+        # are read from the same safetensors file, so later workers load from the page cache
+        uvicorn.run("main:app", workers=WORKERS, **server_options)
+    else:
+        uvicorn.run(app, **server_options)
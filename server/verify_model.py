@@ -7,6 +7,19 @@ import zipfile
 import os
 import sys
 
+def _detect_archive(file_path):
+    """Detect an archive format from magic bytes with a single read ("zip", "gz", "tar" or "none")"""
+    with open(file_path, 'rb') as f:
+        header = f.read(512)
+    
+    if header[:4] == b'PK\x03\x04':
+        return "zip"
+    if header[:2] == b'\x1f\x8b':
+        return "gz"
+    if header[257:262] == b'ustar':
+        return "tar"
+    return "none"
+
 def verify_model_file(file_path):
     """Verify that a file is a valid .pt file, not a ZIP"""
     print(f"Checking file: {file_path}")
@@ -18,19 +31,15 @@ def verify_model_file(file_path):
     file_size = os.path.getsize(file_path) / (1024 * 1024)
     print(f"File size: {file_size:.1f} MB")
     
-    # Check file signature
-    with open(file_path, 'rb') as f:
-        first_bytes = f.read(10)
-        
-    # ZIP files start with PK (0x50 0x4B)
-    is_zip = first_bytes[:2] == b'PK'
+    # Check file signature (read once)
+    archive_format = _detect_archive(file_path)
     
-    if is_zip:
+    if archive_format == "zip":
         print("❌ File is a ZIP archive, not a single .pt file!")
         print("   The conversion may not have worked correctly.")
         
         # Check what's inside
-        if zipfile.is_zipfile(file_path):
+        try:
             with zipfile.ZipFile(file_path, 'r') as zf:
                 files = zf.namelist()
                 print(f"   Contains {len(files)} files/folders")
@@ -42,6 +51,12 @@ def verify_model_file(file_path):
                     print(f"   ✓ Found .pt file(s) inside: {pt_files}")
                 else:
                     print("   ❌ No .pt files found inside ZIP")
+        except zipfile.BadZipFile:
+            print("   ❌ ZIP archive is corrupt")
+        return False
+    elif archive_format in ("gz", "tar"):
+        print(f"❌ File is a {archive_format} archive, not a single .pt file!")
+        print("   Extract it and verify the .pt file inside.")
         return False
     else:
         print("✓ File is NOT a ZIP (good!)")